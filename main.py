@@ -1,19 +1,33 @@
 #!/usr/bin/python
 
-from fileinput import filename
+import functools
 import json
 from datetime import datetime, date
 import os
+import pathlib
 import sys
-from urllib import request
+import tempfile
+import time
 from typing import Union
 
+# Use orjson when it is installed, it parses bytes directly and is a lot faster.
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
 
 # File for getting the energi prices for Denmark West Market. 
 # It writes the energy prices to a json file in the data folder.
 # It also shows the data as a I3 blocks compatible output.
 
 
+DATA_DIR = pathlib.Path(__file__).parent / "data" # Where the price files are stored
+
 url = "https://nrgi.dk/api/common/pricehistory?region=DK1&date=" # This is for Denmark West data
 # url = "https://nrgi.dk/api/common/pricehistory?region=DK2&date=" # This is for Denmark East data
 
@@ -26,75 +40,169 @@ COLORS = [
             '#FF0000'
         ]
 
+# Shared session so connections to nrgi.dk are pooled and kept alive between calls.
+# It is created on first use, see _get_session.
+_SESSION = None
+
 class NoDataException(Exception):
     """No data available. API might be down?"""
 
 
+FAIL_BACKOFF_MIN = 30 # seconds to wait before asking the API again after the first failed fetch
+FAIL_BACKOFF_MAX = 300 # upper bound for the wait, it doubles on every failed fetch
+
 MIN_COLOR = 250 # lower bound for øre price
 MAX_COLOR = 700 # upper bound for øre price
 
-def get_energi_prices(date_obj: date = date.today()) -> dict:
+# Precomputed color buckets for prices between MIN_COLOR and MAX_COLOR.
+_PALETTE = tuple(COLORS[1:-2]) # remove the first and the last two colors
+_VRANGE_INTERVAL = (MAX_COLOR - MIN_COLOR) // len(_PALETTE)
+_LAST = len(_PALETTE) - 1
+
+# Pango elements for the output. Everything we print is ASCII, so it is written as bytes straight to stdout.
+_SPAN_TMPL = '<span fgcolor="black" bgcolor="{bg}"> kW/h {price} </span>\n'
+_ERROR_SPAN = b'<span bgcolor="#FF0000" fgcolor="#000000"> Error loading data ...</span>\n'
+
+def _get_session():
+    """Return the shared requests session, creating it on first use.
+
+    requests is imported here so that calls served from the data folder never pay for importing it.
+
+    Returns:
+        requests.Session: The shared session.
+    """
+    global _SESSION
+    if _SESSION is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        _SESSION = requests.Session()
+        _SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
+        _SESSION.headers.update({"User-Agent": "i3-energy-tracker"})
+    return _SESSION
+
+def get_energi_prices(date_obj: Union[date, None] = None) -> dict:
     """Get the prices for the given data.
 
     Args:
         date_obj (date, optional): Get the prices according to the date object. Defaults to date.today().
 
     Raises:
-        ValueError: If the get request fails return the status code as an error.
+        NoDataException: If the get request fails, times out or doesn't return JSON.
 
     Returns:
         dict: dictionary with the loaded prices.
     """
-    prices = request.urlopen(url+date_obj.isoformat())
-    if prices.status != 200:
-        raise NoDataException(f"Status code {prices.status_code}: Couldn't get the data for energi prices.")
-    return json.loads(prices.read())
-
-
-def write_prices_file(date_obj: date = date.today()) -> str:
+    if date_obj is None:
+        date_obj = date.today()
+    import requests
+    try:
+        resp = _get_session().get(url+date_obj.isoformat(), timeout=5)
+        resp.raise_for_status()
+        return resp.json()
+    except requests.HTTPError:
+        raise NoDataException(f"Status code {resp.status_code}: Couldn't get the data for energi prices.")
+    except (requests.RequestException, ValueError) as e:
+        raise NoDataException(f"Couldn't get the data for energi prices: {e}")
+
+
+def write_prices_file(date_obj: Union[date, None] = None) -> str:
     """Write the prices to a JSON file.
 
     Args:
         date_obj (date, optional): The date for the prices. Defaults to date.today().
 
+    Raises:
+        NoDataException: If the prices couldn't be fetched. No file is written in that case.
+
     Returns:
         str: The filename for the newly written file.
     """
+    if date_obj is None:
+        date_obj = date.today()
     filename = f"prices-{date_obj.isoformat()}.json"
-    path = os.path.join(os.path.dirname(__file__), "data", filename)
-    with open(path, "w") as file:
+    path = DATA_DIR / filename
+    prices = get_energi_prices(date_obj)
+    payload = _json_dumps(prices)
+    # Write to a temp file and swap it in, so a crash never leaves a truncated prices file behind.
+    # The temp file is unique per writer since one i3blocks per monitor may fetch the same day at once.
+    fd, tmp_path = tempfile.mkstemp(dir=DATA_DIR, prefix=filename, suffix=".tmp")
+    try:
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, "wb") as file:
+            file.write(payload)
+        os.replace(tmp_path, path)
+    except BaseException:
         try:
-            prices = get_energi_prices(date_obj)
-            file.write(json.dumps(prices))
-        except NoDataException as e:
-            raise NoDataException(e)
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    # The file on disk changed, so any parsed copy of it is stale.
+    _load_prices_cached.cache_clear()
     return filename 
 
-def read_prices_file(date_obj: date = date.today()) -> Union[dict, None]:
+@functools.lru_cache(maxsize=8)
+def _load_prices_cached(iso: str) -> tuple:
+    """Load and parse the prices file for the given date. Memoized so repeated reads in one process are free.
+
+    Args:
+        iso (str): The date in ISO format.
+
+    Returns:
+        tuple: The price including VAT in øre for each hour of the day.
+    """
+    data = _json_loads((DATA_DIR / f"prices-{iso}.json").read_bytes())
+    return tuple(p["priceInclVat"] for p in data["prices"])
+
+def _read_fail_file(fail_path: pathlib.Path) -> Union[dict, None]:
+    """Read the marker left behind by a failed fetch.
+
+    Args:
+        fail_path (pathlib.Path): Path to the marker file.
+
+    Returns:
+        Union[dict, None]: The "until" timestamp and current "backoff" in seconds, or None if there is no valid marker.
+    """
+    try:
+        return _json_loads(fail_path.read_bytes())
+    except (FileNotFoundError, ValueError):
+        return None
+
+def read_prices_file(date_obj: Union[date, None] = None) -> Union[tuple, None]:
     """Read the json file for the given date.
 
     Args:
         date_obj (date, optional): The data object. Defaults to date.today().
 
     Returns:
-        Union[dict, None]: return the date if it is there.
+        Union[tuple, None]: the price including VAT in øre for each hour if it is there.
     """
-    filename = f"prices-{date_obj.isoformat()}.json"
-    path = os.path.join(os.path.dirname(__file__), "data", filename)
-    if not os.path.exists(path):
-        # If there is no data file then write them to it.
-        try:
-            write_prices_file(date_obj)
-        except NoDataException as e:
-            return None
-    # TODO: Handle the download of correct data better if the data file is corrupt
-    with open(path, "r") as file:
-        try:
-            return json.loads(file.read())
-        except json.JSONDecodeError as e:
-            write_prices_file(date_obj)
-            return None
-
+    if date_obj is None:
+        date_obj = date.today()
+    iso = date_obj.isoformat()
+    # Try the file first, a missing file is the rare case so don't stat it up front.
+    # A corrupt file is handled like a missing one and fetched again.
+    try:
+        return _load_prices_cached(iso)
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+    # If the last fetch failed recently then don't hammer the API again.
+    fail_path = DATA_DIR / f"prices-{iso}.json.fail"
+    fail = _read_fail_file(fail_path)
+    if fail is not None and fail["until"] > time.time():
+        return None
+    # If there is no usable data file then write them to it.
+    try:
+        write_prices_file(date_obj)
+    except NoDataException as e:
+        # Back off exponentially while the API keeps failing.
+        backoff = FAIL_BACKOFF_MIN if fail is None else min(fail["backoff"] * 2, FAIL_BACKOFF_MAX)
+        fail_path.write_bytes(_json_dumps({"until": time.time() + backoff, "backoff": backoff}))
+        return None
+    fail_path.unlink(missing_ok=True)
+    return _load_prices_cached(iso)
+
+@functools.lru_cache(maxsize=128)
 def format_price(price: int) -> str:
     """Format the price from øre to dkk
 
@@ -104,10 +212,12 @@ def format_price(price: int) -> str:
     Returns:
         str: String representation of the price in dkk.
     """
+    # Integer formatting, prices can be negative so split the sign off first.
+    sign = "-" if price < 0 else ""
+    kr, ore = divmod(abs(price), 100)
+    return f"{sign}{kr}.{ore:02d} DKK"
 
-    return f"{price/100:.2f} DKK"
-
-def output_hour_price(date_obj: date = date.today(), hour: int = datetime.now().hour) -> str:
+def output_hour_price(date_obj: Union[date, None] = None, hour: Union[int, None] = None) -> str:
     """Print the energy price for the given date and hour as a pango markup element.
 
     Args:
@@ -117,11 +227,17 @@ def output_hour_price(date_obj: date = date.today(), hour: int = datetime.now().
     Returns:
         str: The pango markup element
     """
-    prices = read_prices_file(date_obj)
-    if prices == None:
-        print("<span bgcolor=\"#FF0000\" fgcolor=\"#000000\"> Error loading data ...</span>")
-    current_hour_price = prices["prices"][hour]["priceInclVat"]
-    print(f"<span fgcolor=\"black\" bgcolor=\"{output_background(current_hour_price)}\"> kW/h {format_price(current_hour_price)} </span>")
+    if date_obj is None:
+        date_obj = date.today()
+    if hour is None:
+        hour = datetime.now().hour
+    prices_by_hour = read_prices_file(date_obj)
+    if prices_by_hour == None:
+        sys.stdout.buffer.write(_ERROR_SPAN)
+        return
+    current_hour_price = prices_by_hour[hour]
+    span = _SPAN_TMPL.format(bg=output_background(current_hour_price), price=format_price(current_hour_price))
+    sys.stdout.buffer.write(span.encode("ascii"))
 
 def output_background(price: int) -> str:
     """Take an integer value and return a HEX color. Uses the MIN_COLOR and MAX_COLOR values to decide range of colors.
@@ -137,33 +253,32 @@ def output_background(price: int) -> str:
     elif price >= MAX_COLOR:
         return(COLORS[-1])
     else:
-        # Split the colors into a range and select a color based on which interval they hit.
-        colors = COLORS[1:-2] # remove the first and second color
-        vrange = MAX_COLOR - MIN_COLOR # create the range
-        vrange_interval = vrange // len(colors)
-        index = (price - MIN_COLOR) // vrange_interval - 1
-        return(colors[index])
+        # Select a color based on which interval of the range the price hits.
+        index = (price - MIN_COLOR) // _VRANGE_INTERVAL
+        return(_PALETTE[min(index, _LAST)])
 
 
 
-def output_day_price(date_obj: date = date.today()) -> str:
+def output_day_price(date_obj: Union[date, None] = None) -> str:
     """
     Output the day prices as a html table. Needs to be change later.
 
     :param date_obj (date, optional): Date you want to see. Defaults to date.today().
     :return str: str ouput of the day.
     """
-    prices = read_prices_file(date_obj)
-    if prices == None:
-        print("<span bgcolor=\"#FF0000\" fgcolor=\"#000000\"> Error loading data ...</span>")
-    day = []
-    day.append(f"The prices for {date_obj.isoformat()} are: \n")
-    for hour, data in enumerate(prices["prices"]):
-
-        # day.append(f"<tr><td>{hour}</td><td style=\"background-color: {output_background(data['priceInclVat'])}\"> {data['priceInclVat']} </td></tr>\n")
-        day.append(f"<span color=\"{output_background(data['priceInclVat'])}\">Hour: {hour:02d} :  {format_price(data['priceInclVat'])}</span>\n")
-    # print(''.join(day))
-    sys.stdout.write(''.join(day))
+    if date_obj is None:
+        date_obj = date.today()
+    prices_by_hour = read_prices_file(date_obj)
+    if prices_by_hour == None:
+        sys.stdout.buffer.write(_ERROR_SPAN)
+        return
+    colors = [output_background(price) for price in prices_by_hour]
+    lines = [f"The prices for {date_obj.isoformat()} are: \n".encode("ascii")]
+    lines.extend(
+        f"<span color=\"{colors[hour]}\">Hour: {hour:02d} :  {format_price(price)}</span>\n".encode("ascii")
+        for hour, price in enumerate(prices_by_hour)
+    )
+    sys.stdout.buffer.writelines(lines)
 
 if __name__ == "__main__":
     args = sys.argv[1:]
@@ -177,9 +292,10 @@ if __name__ == "__main__":
     if len(args) < 1:
         print(menu)
     elif args[0] == "now":
-        output_hour_price()
+        now = datetime.now()
+        output_hour_price(now.date(), now.hour)
     elif args[0] == "day":
-        output_day_price()
+        output_day_price(date.today())
     elif args[0] == '-h' or args[0] == "h":
         print(menu)
     else: